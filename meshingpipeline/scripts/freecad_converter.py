@@ -13,18 +13,14 @@ def stl_to_brep(stl_path, brep_path, tolerance=0.05):
     mesh = Mesh.Mesh(stl_path)
     shape = Part.Shape()
     shape.makeShapeFromMesh(mesh.Topology, tolerance)
+    # the mesh faces are not sewn, so go straight to a shell rather than attempting makeSolid first
     try:
-        # Try to create a solid directly
-        solid = Part.makeSolid(shape)
+        shell = Part.Shell(shape.Faces)
+        solid = Part.Solid(shell)
     except Exception:
-        try:
-            # if that fails, try to create a solid from the shell
-            shell = Part.Shell(shape.Faces)
-            solid = Part.Solid(shell)
-        except Exception:
-            shape.exportBrep(brep_path)
-            print("Could not form solid. Exporting compound/shape to", brep_path)
-            return
+        shape.exportBrep(brep_path)
+        print("Could not form solid. Exporting compound/shape to", brep_path)
+        return
     # export solid to brep if successful
     solid.exportBrep(brep_path)
     print('Exported BRep:', brep_path)
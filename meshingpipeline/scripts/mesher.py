@@ -5,7 +5,9 @@ Creates a bounding box around the shape, centers and scales it to unit height
 Assigns physical groups and saves the mesh in MSH format.
 
 Usage:
-    python mesher.py input.brep [options]
+    python mesher.py input.brep [more_inputs.brep ...] [options]
+
+Gmsh is initialized once and reused for all passed files.
 
 Options:
     --suppress               Suppress verbose output
@@ -13,6 +15,7 @@ Options:
     --paradermal-margin f    Margin fraction for the free bbox space in the paradermal direction (default 0.05)
     --substomatal-margin f   Margin fraction for the free bbox space in the substomatal cavity direction (default 0.1)
     --open-gui               Open the Gmsh GUI to visualize the mesh after generation
+    --threads N              Number of threads for parallel meshing with the HXT algorithm (default $GMSH_THREADS or all cores)
 
 """
 
@@ -26,6 +29,7 @@ kernel = gmsh.model.occ
 
 PARADERMAL_MARGIN_FRACTION = 0.05
 SUBSTOMATAL_CAVITY_MARGIN_FRACTION = 0.1
+DEFAULT_THREADS = int(os.environ.get("GMSH_THREADS", os.cpu_count() or 1))
 
 
 def get_bbox(dim, tag):
@@ -37,45 +41,55 @@ def get_bbox(dim, tag):
     return bbox_center, bbox_size
 
 
-def main(argv=None):
+def _build_parser():
     p = argparse.ArgumentParser(description="Generate volumetric mesh from BRep file using Gmsh.")
-    p.add_argument("input_brep", type=str, help="Input BRep file.")
+    p.add_argument("input_brep", type=str, nargs="+", help="Input BRep file(s).")
     p.add_argument("--suppress", default=False, action="store_true", help="Suppress verbose output")
     p.add_argument("--suppress-gmsh", default=True, action="store_false", help="Suppress Gmsh terminal output")
     p.add_argument("--paradermal-margin", type=float, default=PARADERMAL_MARGIN_FRACTION, help=f"Margin fraction for the free bbox space in the paradermal direction (default {PARADERMAL_MARGIN_FRACTION})")
     p.add_argument("--substomatal-margin", type=float, default=SUBSTOMATAL_CAVITY_MARGIN_FRACTION, help=f"Margin fraction for the free bbox space in the substomatal cavity direction (default {SUBSTOMATAL_CAVITY_MARGIN_FRACTION})")
     p.add_argument("--open-gui", default=False, action="store_true", help="Open the Gmsh GUI to visualize the mesh after generation")
-    #
-    args = p.parse_args(argv)
+    p.add_argument("--threads", type=int, default=DEFAULT_THREADS, help=f"Number of threads for parallel meshing (default {DEFAULT_THREADS}, overridable via GMSH_THREADS)")
+    return p
 
+
+def mesh_one(brep_path, args, n=0):
+    # assumes gmsh is initialized, meshes into a fresh model that is removed again on exit
     # check if file exists
-    if not os.path.isfile(args.input_brep):
-        raise FileNotFoundError(f"Input file {args.input_brep} does not exist.")
-    
-    # initialize gmsh
-    gmsh.initialize()
-    gmsh.model.add("Leaf_plug_model")
+    if not os.path.isfile(brep_path):
+        raise FileNotFoundError(f"Input file {brep_path} does not exist.")
 
-    # suppress gmsh output if requested
-    if args.suppress or args.suppress_gmsh:
-        gmsh.option.setNumber("General.Terminal", 0)  # Suppress terminal output
+    gmsh.model.add(f"Leaf_plug_model_{n}")
+    try:
+        return _mesh_model(brep_path, args)
+    finally:
+        gmsh.model.remove()
 
+
+def _mesh_model(brep_path, args):
     # import the BRep file
-    shape = kernel.importShapes(args.input_brep)
+    shape = kernel.importShapes(brep_path)
     kernel.synchronize()
     if not args.suppress:
-        print(f"Imported shape from {args.input_brep}")
+        print(f"Imported shape from {brep_path}")
 
     # center and scale to unit height
     center, size = get_bbox(*shape[0])
     scale = 1.0 / size[2]  # size[2] is the z-extent
-    kernel.translate(shape, -center[0], -center[1], -(center[2]-size[2]/2))
-    kernel.dilate(shape, 0, 0, 0, scale, scale, scale)
-    kernel.translate(shape, 0, 0, args.substomatal_margin) # has unit height now so no multiplication needed
-    kernel.synchronize()
+    # compose translate -> dilate -> translate into a single OCC affine transform
+    shift = np.eye(4)
+    shift[:3, 3] = -center[0], -center[1], -(center[2]-size[2]/2)
+    dilate = np.diag([scale, scale, scale, 1.0])
+    lift = np.eye(4)
+    lift[2, 3] = args.substomatal_margin # has unit height now so no multiplication needed
+    transform = lift @ dilate @ shift
+    kernel.affineTransform(shape, list(transform[:3].flatten())) # gmsh expects the first 3 rows
+
+    # the transformed bounding box follows from the original one, no need to query OCC again
+    center = np.array([0.0, 0.0, 0.5 + args.substomatal_margin])
+    size = np.array([size[0]*scale, size[1]*scale, 1.0])
 
     # draw a box matching the shape's bounding box (plus some margin)
-    center, size = get_bbox(*shape[0])
     marginx = args.paradermal_margin * size[0] / 2
     marginy = args.paradermal_margin * size[1] / 2
     marginz = args.substomatal_margin * size[2]
@@ -97,11 +111,37 @@ def main(argv=None):
         gmsh.fltk.run()  # Open the GUI to visualize the mesh
 
     # save mesh
-    output_mesh = os.path.splitext(args.input_brep)[0] + ".msh"
+    output_mesh = os.path.splitext(brep_path)[0] + ".msh"
     gmsh.write(output_mesh)
-    # finalize gmsh
-    gmsh.finalize()
+    return output_mesh
+
+
+def main_batch(breps, args):
+    # initialize gmsh once for all inputs
+    gmsh.initialize()
+    try:
+        # suppress gmsh output if requested
+        if args.suppress or args.suppress_gmsh:
+            gmsh.option.setNumber("General.Terminal", 0)  # Suppress terminal output
+
+        # use the parallel HXT algorithm for the 3D step
+        gmsh.option.setNumber("General.NumThreads", args.threads)
+        gmsh.option.setNumber("Mesh.MaxNumThreads1D", args.threads)
+        gmsh.option.setNumber("Mesh.MaxNumThreads2D", args.threads)
+        gmsh.option.setNumber("Mesh.MaxNumThreads3D", args.threads)
+        gmsh.option.setNumber("Mesh.Algorithm3D", 10)  # HXT
+
+        for n, brep in enumerate(breps):
+            mesh_one(brep, args, n)
+    finally:
+        # finalize gmsh
+        gmsh.finalize()
     return 0
 
+
+def main(argv=None):
+    args = _build_parser().parse_args(argv)
+    return main_batch(args.input_brep, args)
+
 if __name__ == "__main__":
     raise SystemExit(main())
\ No newline at end of file
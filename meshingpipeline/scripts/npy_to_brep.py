@@ -10,7 +10,10 @@ The code will produce an .stl and a .brep file in the same directory
 as the input .npy file and inherit its file name.
 
 Usage:
-    python npy_to_brep.py path/to/your_file.npy [options]
+    python npy_to_brep.py path/to/your_file.npy [more_files.npy ...] [options]
+
+When several files are passed, the FreeCAD conversion of one file runs
+in the background while the next file is meshed.
 
 Options:
     --spacing sx,sy,sz       Voxel spacing in each dimension (default 1.0,1.0,1.0)
@@ -19,117 +22,383 @@ Options:
     --suppress               Suppress verbose output
     --smoothing_iter N       Number of Taubin smoothing iterations (default 10)
     --decimate N             Target number of triangles after decimation (default 10,000)
+    --mc-step N              Marching cubes step size in voxels (default 1)
+    --cache-mc               Cache the generated STL (keyed on voxel content and mesh parameters) and reuse it on later runs
 """
 
 import os
+import mmap
+import shutil
+import hashlib
 import subprocess
 import argparse
+from collections import deque
 import numpy as np 
 import open3d as o3d
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from numba import njit, prange
 from skimage import measure
 
 DEFAULT_FREECAD_CMD = "freecadcmd-daily"
 DEFAULT_FREECAD_SCRIPT = os.path.join(os.path.dirname(__file__), "freecad_converter.py")
 DEFAULT_SMOOTHING_ITER = 10
 DEFAULT_DECIMATE = 10_000
+DEFAULT_MC_STEP = 1
+DEFAULT_TAUBIN_LAMBDA = 0.5 # same as Open3D's filter_smooth_taubin
+DEFAULT_TAUBIN_MU = -0.53
+DEFAULT_MC_BLOCK = 32 # edge length (in cells) of the marching cubes blocks
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "meshingpipeline")
+
+
+def clean_mesh_np(verts, faces):
+    # merge duplicated vertices
+    verts, inverse = np.unique(verts, axis=0, return_inverse=True)
+    faces = inverse.reshape(-1)[faces]
+    # remove degenerate triangles
+    mask = (faces[:,0] != faces[:,1]) & (faces[:,1] != faces[:,2]) & (faces[:,0] != faces[:,2])
+    faces = faces[mask]
+    # remove duplicated triangles (regardless of winding), keeping the first occurrence
+    _, first = np.unique(np.sort(faces, axis=1), axis=0, return_index=True)
+    faces = faces[np.sort(first)]
+    # remove unreferenced vertices
+    used = np.zeros(len(verts), dtype=bool)
+    used[faces] = True
+    remap = np.cumsum(used) - 1
+    return verts[used], remap[faces]
+
+
+def to_o3d_mesh(verts, faces):
+    # float64/int32 contiguous buffers match Open3D's vector layout, so no extra conversion pass
+    verts = np.ascontiguousarray(verts, dtype=np.float64)
+    faces = np.ascontiguousarray(faces, dtype=np.int32)
+    return o3d.geometry.TriangleMesh(o3d.utility.Vector3dVector(verts), o3d.utility.Vector3iVector(faces))
+
+
+def write_binary_stl(path, verts, faces):
+    # binary STL: 80 byte header, uint32 triangle count, then per triangle
+    # the facet normal, its three vertices (all float32) and a uint16 attribute
+    v = verts[faces].astype('<f4')
+    normals = np.cross(v[:,1] - v[:,0], v[:,2] - v[:,0])
+    normals /= np.linalg.norm(normals, axis=1, keepdims=True) + 1e-20
+    records = np.zeros(len(faces), dtype=[('n', '<f4', (3,)), ('v', '<f4', (3, 3)), ('a', '<u2')])
+    records['n'] = normals
+    records['v'] = v
+    with open(path, 'wb') as f:
+        f.write(b'\x00' * 80)
+        np.array([len(faces)], dtype='<u4').tofile(f)
+        records.tofile(f)
+    return os.path.getsize(path) == 84 + records.itemsize * len(faces)
 
 
 def clean_mesh(mesh):
-    mesh.remove_duplicated_vertices()
-    mesh.remove_duplicated_triangles()
-    mesh.remove_degenerate_triangles()
-    mesh.remove_unreferenced_vertices()
+    verts, faces = clean_mesh_np(np.asarray(mesh.vertices), np.asarray(mesh.triangles))
+    mesh = to_o3d_mesh(verts, faces)
     mesh.compute_vertex_normals()
     return mesh
 
 
-def main(argv=None):
+def _to_csr(rows, cols, n):
+    order = np.argsort(rows, kind="stable")
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+    return indptr, cols[order].astype(np.int64)
+
+
+def _edge_keys(a, b):
+    # pack each undirected edge (a, b) into one int64 so edges sort and dedupe in 1-D
+    lo = np.minimum(a, b).astype(np.int64)
+    hi = np.maximum(a, b).astype(np.int64)
+    return (lo << 32) | hi
+
+
+def vertex_adjacency(faces, n_verts):
+    # unique undirected edges of the triangle mesh, stored in both directions
+    keys = np.unique(_edge_keys(faces.reshape(-1), faces[:, [1, 2, 0]].reshape(-1)))
+    lo, hi = keys >> 32, keys & 0xFFFFFFFF
+    rows = np.concatenate([lo, hi])
+    cols = np.concatenate([hi, lo])
+    return _to_csr(rows, cols, n_verts)
+
+
+@njit(parallel=True, cache=True)
+def _jacobi(verts, out, indptr, indices, weight):
+    # one uniform Laplacian step: move each vertex towards its neighbour centroid
+    for i in prange(verts.shape[0]):
+        start, stop = indptr[i], indptr[i+1]
+        cx, cy, cz = 0.0, 0.0, 0.0
+        for k in range(start, stop):
+            j = indices[k]
+            cx += verts[j,0]
+            cy += verts[j,1]
+            cz += verts[j,2]
+        if stop > start:
+            inv = 1.0 / (stop - start)
+            out[i,0] = verts[i,0] + weight * (cx * inv - verts[i,0])
+            out[i,1] = verts[i,1] + weight * (cy * inv - verts[i,1])
+            out[i,2] = verts[i,2] + weight * (cz * inv - verts[i,2])
+        else:
+            out[i,0], out[i,1], out[i,2] = verts[i,0], verts[i,1], verts[i,2]
+
+
+@njit(cache=True)
+def taubin(verts, indptr, indices, lam, mu, n):
+    buffer = np.empty_like(verts)
+    for _ in range(n):
+        _jacobi(verts, buffer, indptr, indices, lam)
+        _jacobi(buffer, verts, indptr, indices, mu)
+    return verts
+
+
+def smooth_taubin(verts, faces, n, lam=DEFAULT_TAUBIN_LAMBDA, mu=DEFAULT_TAUBIN_MU):
+    verts = np.array(verts, dtype=np.float64) # smoothed in place, so never alias the input
+    indptr, indices = vertex_adjacency(faces, len(verts))
+    return taubin(verts, indptr, indices, lam, mu, n)
+
+
+def _check_mesh(faces):
+    # half-edge h = 3*f + k runs from corner 3*f + k to corner 3*f + (k+1)%3 of face f
+    n_faces = len(faces)
+    start = np.arange(3 * n_faces)
+    end = 3 * (start // 3) + (start + 1) % 3
+    corners = faces.reshape(-1)
+    _, edge_id, counts = np.unique(_edge_keys(corners[start], corners[end]), return_inverse=True, return_counts=True)
+    edge_manifold = bool(counts.max() <= 2)
+
+    # link the corners of the two faces on either side of each edge at both shared vertices
+    order = np.argsort(edge_id, kind="stable")
+    shared = edge_id[order[1:]] == edge_id[order[:-1]]
+    h1, h2 = order[:-1][shared], order[1:][shared]
+    aligned = corners[start[h1]] == corners[start[h2]]
+    rows = np.concatenate([start[h1], end[h1]])
+    cols = np.concatenate([np.where(aligned, start[h2], end[h2]), np.where(aligned, end[h2], start[h2])])
+    graph = coo_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)), shape=(3 * n_faces, 3 * n_faces))
+    n_fans, fan = connected_components(graph, directed=False)
+    # a vertex is manifold if all of its incident faces form a single edge-connected fan
+    fans_per_vertex = np.unique(corners.astype(np.int64) * n_fans + fan)
+    vertex_manifold = len(fans_per_vertex) == len(np.unique(corners))
+
+    # closed 2-manifold: every edge is shared by exactly two faces
+    watertight = bool((counts == 2).all()) and vertex_manifold
+    return edge_manifold, vertex_manifold, watertight
+
+
+def load_voxels(path):
+    # memory-map the array so pages are read in lazily as the stencil pass streams through them
+    voxels = np.load(path, mmap_mode='r')
+    mm = getattr(voxels, "_mmap", None)
+    if mm is not None and hasattr(mmap, "MADV_SEQUENTIAL"):
+        mm.madvise(mmap.MADV_SEQUENTIAL) # read-ahead aggressively, drop pages behind
+    return voxels
+
+
+def _pack_voxels(voxels, level, chunk):
+    # in/out state packed 8 grid points per byte along z; the last byte is padded
+    # with the last real value so padding never looks like a surface
+    pad = -voxels.shape[2] % 8
+    slabs = []
+    for i in range(0, voxels.shape[0], chunk):
+        inside = voxels[i:i+chunk] >= level
+        slabs.append(np.packbits(np.pad(inside, [(0, 0), (0, 0), (0, pad)], mode="edge"), axis=-1))
+    return np.concatenate(slabs)
+
+
+def _reduce_blocks(a, starts, axis):
+    # or-reduce windows [starts[i], starts[i+1]] (inclusive) along axis, so that
+    # consecutive windows share their boundary entry like the blocks share grid points
+    a = np.moveaxis(a, axis, 0)
+    out = np.logical_or.reduceat(a, starts, axis=0)
+    out[:-1] |= a[starts[1:]]
+    return np.moveaxis(out, 0, axis)
+
+
+def _marching_cubes(voxels, spacing, level=0.5, step=1, block=DEFAULT_MC_BLOCK):
+    # blocks are a multiple of the step size so coarse cells never straddle two blocks,
+    # and a multiple of 8 so they start on a byte of the packed z-axis
+    block = -(-block // np.lcm(step, 8)) * np.lcm(step, 8)
+    packed = _pack_voxels(voxels, level, block)
+
+    # coarse pass: a block carries surface unless all of its grid points agree,
+    # which is tested on whole bytes (8 stencil corners) at a time
+    n_blocks = [-(-(n - 1) // block) for n in voxels.shape]
+    any_in, any_out = packed != 0, packed != 0xFF
+    for axis, nb in enumerate(n_blocks):
+        starts = np.arange(nb) * (block // 8 if axis == 2 else block)
+        any_in = _reduce_blocks(any_in, starts, axis)
+        any_out = _reduce_blocks(any_out, starts, axis)
+    active_blocks = any_in & any_out
+    if not active_blocks.any():
+        raise RuntimeError("No surface found in the voxel volume.")
+
+    # fine pass: full resolution marching cubes inside each active block.
+    # Blocks share their boundary plane of grid points but not their cells,
+    # so every triangle is produced exactly once.
+    all_verts, all_faces, n_verts = [], [], 0
+    for idx in np.argwhere(active_blocks):
+        start = idx * block
+        stop = np.minimum(start + block + 1, voxels.shape)
+        # the unpacked uint8 in/out mask is all marching cubes needs (normals are recomputed later)
+        sub = np.unpackbits(packed[start[0]:stop[0], start[1]:stop[1], start[2]//8:-(-stop[2]//8)],
+                            axis=-1, count=stop[2] - start[2])
+        if sub.all() or not sub.any():
+            continue # the byte-wise test may flag a block whose surface lies just beyond it
+        try:
+            verts, faces, _, _ = measure.marching_cubes(sub, level=0.5, step_size=step, allow_degenerate=False, method='lewiner')
+        except RuntimeError:
+            continue # with step > 1 the surface can fall between the coarse grid points
+        all_verts.append(verts + start)  # unit spacing keeps shared vertices bit-identical
+        all_faces.append(faces + n_verts)
+        n_verts += len(verts)
+
+    if not all_verts:
+        raise RuntimeError("No surface found in the voxel volume.")
+
+    # weld the duplicated vertices on shared block boundaries. On the binary mask every
+    # vertex sits halfway along a grid edge, so doubled index coordinates are exact integers
+    # and a flat index into the doubled grid is a collision-free 1-D key.
+    verts = np.concatenate(all_verts)
+    key = np.ravel_multi_index(np.round(2 * verts).astype(np.int64).T, [2 * n - 1 for n in voxels.shape])
+    _, unique_idx, inverse = np.unique(key, return_index=True, return_inverse=True)
+    faces = inverse[np.concatenate(all_faces)]
+    return verts[unique_idx] * np.asarray(spacing), faces
+
+
+def _build_parser():
     p = argparse.ArgumentParser(description="Convert water tight voxel representation in .npy to CAD model in .brep")
-    p.add_argument("input_npy", type=str, help="Path to the input .npy file containing a 3D array (boolean or 0/1)")
+    p.add_argument("input_npy", type=str, nargs="+", help="Path(s) to the input .npy file(s) containing a 3D array (boolean or 0/1)")
     p.add_argument("--spacing", type=lambda s: tuple(float(x) for x in s.split(',')), default=(1.0,1.0,1.0), help="voxel spacing sx,sy,sz (default 1.0,1.0,1.0)")
     p.add_argument("--freecad-cmd", default=DEFAULT_FREECAD_CMD, help="Path to the FreeCAD command line tool")
     p.add_argument("--freecad-script", default=DEFAULT_FREECAD_SCRIPT, help=f"Path to a custom FreeCAD conversion script (default assumes script is in the same directory as {__file__})") 
     p.add_argument("--suppress", default=False, action="store_true", help="Suppress verbose output")
     p.add_argument("--smoothing-iter", type=int, default=DEFAULT_SMOOTHING_ITER, help="Number of Taubin smoothing iterations (default 10)")
     p.add_argument("--decimate", type=int, default=DEFAULT_DECIMATE, help="Target number of triangles after decimation (default 10.000)")
-    args = p.parse_args(argv)
-    
+    p.add_argument("--cache-mc", default=False, action="store_true", help=f"Cache the generated STL in {DEFAULT_CACHE_DIR} and reuse it for identical voxels and parameters")
+    p.add_argument("--mc-step", type=int, default=DEFAULT_MC_STEP, help="Marching cubes step size in voxels, larger gives a coarser mesh (default 1)")
+    return p
+
+
+def _cache_path(voxels, args):
+    # key the cached STL on the voxel content plus every parameter that shapes the mesh
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr((voxels.shape, voxels.dtype.str, tuple(args.spacing))).encode())
+    h.update(np.ascontiguousarray(voxels).data)
+    name = f"{h.hexdigest()}_{args.mc_step}_{args.smoothing_iter}_{args.decimate}.stl"
+    return os.path.join(DEFAULT_CACHE_DIR, name)
+
+
+def _launch_freecad(stl_path, brep_path, args):
+    if not args.suppress: print(f"Converting to BRep via FreeCAD to {brep_path} ...")
+
+    # assign environment variables for FreeCAD script
+    env = os.environ.copy()
+    env['INPUT_STL'] = os.path.abspath(stl_path)
+    env['OUTPUT_BREP'] = os.path.abspath(brep_path)
+
+    # launch FreeCAD in headless mode with the conversion script without waiting for it
+    try:
+        return subprocess.Popen([args.freecad_cmd, args.freecad_script], env=env,
+                                stdout=subprocess.DEVNULL if args.suppress else None, stderr=subprocess.PIPE)
+    except Exception as e:
+        print("Error running FreeCAD command:", e)
+    return None
+
+
+def convert_one(npy, args):
     # make sure that the input file exists
-    if not os.path.isfile(args.input_npy):
-        raise FileNotFoundError(f"Input file {args.input_npy} does not exist.")
+    if not os.path.isfile(npy):
+        raise FileNotFoundError(f"Input file {npy} does not exist.")
+    stl_path = os.path.splitext(npy)[0] + ".stl"
+    brep_path = os.path.splitext(npy)[0] + ".brep"
     
     # load file
-    voxels = np.load(args.input_npy)
+    voxels = load_voxels(npy)
     if not args.suppress: print("loaded volume shape:", voxels.shape, 'spacing:', args.spacing)
 
+    # reuse a previously generated (manifold and water tight) mesh for the same input and parameters
+    cache_path = _cache_path(voxels, args) if args.cache_mc else None
+    if cache_path is not None and os.path.isfile(cache_path):
+        shutil.copyfile(cache_path, stl_path)
+        if not args.suppress: print(f"Reused cached mesh {cache_path} as {stl_path}")
+        return _launch_freecad(stl_path, brep_path, args)
+
     # convert to triangular surface mesh using Open3D
-    verts, faces, normals, values = measure.marching_cubes(voxels, spacing=args.spacing, level=0.5)
-    mesh = o3d.geometry.TriangleMesh()
-    mesh.vertices = o3d.utility.Vector3dVector(verts)
-    mesh.triangles = o3d.utility.Vector3iVector(faces)
-    mesh = clean_mesh(mesh)
-    if not args.suppress: print("Initial triangles=", len(np.asarray(mesh.triangles)), "vertices=", len(np.asarray(mesh.vertices)))
+    # welded, degenerate-free and without duplicated triangles, so no clean up needed here
+    verts, faces = _marching_cubes(voxels, args.spacing, step=args.mc_step)
+    mesh = to_o3d_mesh(verts, faces)
+    mesh.compute_vertex_normals()
+    if not args.suppress: print("Initial triangles=", len(mesh.triangles), "vertices=", len(mesh.vertices))
 
     # apply mesh decimation
     if not args.suppress: print(f"Decimating mesh to ~{args.decimate} triangles...")
-    current = len(np.asarray(mesh.triangles)) # get current triangle count
+    current = len(mesh.triangles) # get current triangle count
     target = args.decimate
-    if not target >= current:
-        mesh = mesh.simplify_quadric_decimation(target_number_of_triangles=target)
-    mesh = clean_mesh(mesh)
-    if not args.suppress: print("Post-decimation triangles=", len(np.asarray(mesh.triangles)), "vertices=", len(np.asarray(mesh.vertices)))
+    if current > target * 1.05: # skip decimation that would barely reduce the mesh
+        mesh = mesh.simplify_quadric_decimation(target_number_of_triangles=target, maximum_error=float('inf'), boundary_weight=1.0)
+        mesh = clean_mesh(mesh)
+    if not args.suppress: print("Post-decimation triangles=", len(mesh.triangles), "vertices=", len(mesh.vertices))
 
     # apply smoothing
     if not args.suppress: print(f"Applying {args.smoothing_iter} Taubin smoothing iterations...")
-    mesh = mesh.filter_smooth_taubin(number_of_iterations=args.smoothing_iter)
+    verts = smooth_taubin(np.asarray(mesh.vertices), np.asarray(mesh.triangles), args.smoothing_iter)
+    mesh.vertices = o3d.utility.Vector3dVector(verts)
     mesh = clean_mesh(mesh)
 
     # check that mesh is manifold and water tight
-    edge_manifold = mesh.is_edge_manifold()
-    vertex_manifold = mesh.is_vertex_manifold()
-    watertight = mesh.is_watertight()
+    edge_manifold, vertex_manifold, watertight = _check_mesh(np.asarray(mesh.triangles))
     if not args.suppress: print("Mesh manifold:", edge_manifold, vertex_manifold, "Watertight:", watertight)
     
     # abort if these conditions are not met
     if not (edge_manifold and vertex_manifold and watertight):
         print("Error: Mesh is not manifold and watertight. Cannot convert to BREP.")
         # save as .stl for inspection
-        stl_path = os.path.splitext(args.input_npy)[0] + ".stl"
-        written = o3d.io.write_triangle_mesh(stl_path, mesh)
+        written = write_binary_stl(stl_path, np.asarray(mesh.vertices), np.asarray(mesh.triangles))
         if not written:
             raise RuntimeError(f"Failed to write STL file to {stl_path}")
         print(f"Saved non-manifold mesh as {stl_path} for inspection.")
         
     else:
         # given that the mesh is manifold and water tight, save as .stl and proceed to BREP conversion
-        stl_path = os.path.splitext(args.input_npy)[0] + ".stl"
-        written = o3d.io.write_triangle_mesh(stl_path, mesh)
+        written = write_binary_stl(stl_path, np.asarray(mesh.vertices), np.asarray(mesh.triangles))
         if not written:
             raise RuntimeError(f"Failed to write STL file to {stl_path}")
         if not args.suppress: print(f"Saved STL file to {stl_path}")
+        if cache_path is not None:
+            os.makedirs(DEFAULT_CACHE_DIR, exist_ok=True)
+            shutil.copyfile(stl_path, cache_path)
+        return _launch_freecad(stl_path, brep_path, args)
 
-        # prepare script for FreeCAD
-        brep_path = os.path.splitext(args.input_npy)[0] + ".brep"
-        if not args.suppress: print(f"Converting to BRep via FreeCAD to {brep_path} ...")
-        
-        # attempt FreeCAD conversion
+    return None
+
+
+def _wait_freecad(proc, args):
+    # communicate (rather than wait) drains stderr so FreeCAD never blocks on a full pipe
+    _, stderr = proc.communicate()
+    if proc.returncode != 0:
+        print("FreeCAD process failed with return code:", proc.returncode)
+        if stderr: print(stderr.decode(errors="replace"))
+    else:
+        if not args.suppress: print("FreeCAD conversion completed successfully.")
 
-        # assign environment variables for FreeCAD script
-        env = os.environ.copy()
-        env['INPUT_STL'] = os.path.abspath(stl_path)
-        env['OUTPUT_BREP'] = os.path.abspath(brep_path)
-        
-        # call FreeCAD in headless mode with the conversion script
-        try:
-            process = subprocess.run([args.freecad_cmd, args.freecad_script], env=env)
-            if process.returncode != 0:
-                print("FreeCAD process failed with return code:", process.returncode)
-            else:
-                if not args.suppress: print("FreeCAD conversion completed successfully.")
-        except Exception as e:
-            print("Error running FreeCAD command:", e)
 
+def main_batch(npys, args):
+    # keep a bounded number of FreeCAD conversions running while the next volumes are meshed
+    max_procs = min(os.cpu_count() or 1, len(npys))
+    running = deque()
+    for npy in npys:
+        proc = convert_one(npy, args)
+        if proc is not None:
+            running.append(proc)
+        while len(running) >= max_procs:
+            _wait_freecad(running.popleft(), args)
+    # drain the remaining conversions in FIFO order
+    while running:
+        _wait_freecad(running.popleft(), args)
     return 0
 
+
+def main(argv=None):
+    args = _build_parser().parse_args(argv)
+    return main_batch(args.input_npy, args)
+
 if __name__ == "__main__":
     raise SystemExit(main())